@@ -0,0 +1,148 @@
+"""
+asyncio counterpart of the pipeline in use_queue.py.
+
+Stages that mostly wait on I/O tie up an OS thread each with `StoppableWorker`.
+Here every worker is a task on one event loop, so a stage can keep tens of
+thousands of items in flight on a single thread. Queues, sentinels and
+shutdown follow `ClosableQueue` and `Pipeline`; sync or CPU-bound stage
+functions are pushed to executors with `in_thread` and `in_executor`.
+"""
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+
+class AsyncClosableQueue(asyncio.Queue):
+    SENTINEL = object()
+
+    async def close(self):
+        await self.put(self.SENTINEL)
+
+    async def __aiter__(self):
+        while True:
+            item = await self.get()
+            try:
+                if item is self.SENTINEL:
+                    return
+                yield item
+            finally:
+                self.task_done()
+
+
+class AsyncStoppableWorker(object):
+    """Task applying the coroutine function `func` to each item of `in_queue`."""
+    def __init__(self, func, in_queue, out_queue):
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        async for item in self.in_queue:
+            result = await self.func(item)
+            await self.out_queue.put(result)
+
+    async def join(self):
+        await self.task
+
+
+class AsyncStage(object):
+    """
+    One step of an `AsyncPipeline`: the coroutine function `func` run by
+    `concurrency` worker tasks reading from an input queue of at most
+    `maxsize` items (0 for unbounded).
+    """
+    def __init__(self, func, concurrency=1, maxsize=0):
+        assert concurrency >= 1, concurrency
+        self.func = func
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+
+
+class AsyncPipeline(object):
+    """Same wiring and shutdown as `use_queue.Pipeline`, on one event loop."""
+    def __init__(self, stages, done_maxsize=0):
+        self.queues = [AsyncClosableQueue(stage.maxsize) for stage in stages]
+        self.done_queue = AsyncClosableQueue(done_maxsize)
+        out_queues = self.queues[1:] + [self.done_queue]
+        self.workers = [[AsyncStoppableWorker(stage.func, in_queue, out_queue)
+                         for _ in range(stage.concurrency)]
+                        for stage, in_queue, out_queue in zip(stages, self.queues, out_queues)]
+
+    def start(self):
+        for stage_workers in self.workers:
+            for worker in stage_workers:
+                worker.start()
+
+    async def put(self, item):
+        await self.queues[0].put(item)
+
+    async def close(self):
+        """Shut down the stages in order, once all items put so far are done."""
+        for in_queue, stage_workers in zip(self.queues, self.workers):
+            # one sentinel per worker, each worker stops at the first it gets
+            for _ in stage_workers:
+                await in_queue.close()
+            await in_queue.join()
+            for worker in stage_workers:
+                await worker.join()
+
+
+def in_executor(func, executor=None):
+    """
+    Adapt the blocking function `func` to an async stage function that runs it
+    in `executor`, the loop's default thread pool if None. Use a
+    `ProcessPoolExecutor` for CPU-bound functions.
+    """
+    async def run(item):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, item)
+    functools.update_wrapper(run, func)
+    return run
+
+
+def in_thread(func):
+    return in_executor(func, None)
+
+
+async def fetch(item):
+    # stand-in for a network call
+    await asyncio.sleep(0.1)
+    return item
+
+
+def square(x):
+    return x * x
+
+
+async def run_async_Queue(num_items=20000, concurrency=10000):
+    pipeline = AsyncPipeline([AsyncStage(fetch, concurrency, maxsize=concurrency),
+                              AsyncStage(in_thread(square), 4, maxsize=1000),
+                              AsyncStage(fetch, concurrency, maxsize=concurrency)])
+    pipeline.start()
+    start = time()
+    for i in range(num_items):
+        await pipeline.put(i)
+    await pipeline.close()
+    end = time()
+    print(f'{pipeline.done_queue.qsize()} items finished in {end-start:.3f} seconds '
+          f'with {concurrency} in flight per I/O stage')
+
+
+async def run_process_stage(num_items=100):
+    with ProcessPoolExecutor() as executor:
+        pipeline = AsyncPipeline([AsyncStage(in_executor(square, executor), 4)])
+        pipeline.start()
+        for i in range(num_items):
+            await pipeline.put(i)
+        await pipeline.close()
+    print(f'{pipeline.done_queue.qsize()} items squared in a process pool')
+
+
+if __name__ == '__main__':
+    asyncio.run(run_async_Queue())
+    asyncio.run(run_process_stage())
@@ -15,7 +15,15 @@ function receives the value passed to the `send` function as the result of the
 corresponding `yield` expression.
 """
 
-from collections import namedtuple
+import os
+import struct
+import tempfile
+from collections import Counter, namedtuple
+from multiprocessing import Barrier, Process, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from time import time
+
+import numpy as np
 
 
 def my_coroutine():
@@ -79,9 +87,9 @@ def game_logic(state, neighbors):
             return EMPTY
         elif neighbors > 3:
             return EMPTY
-        else:
-            if neighbors == 3:
-                return ALIVE
+    else:
+        if neighbors == 3:
+            return ALIVE
     return state
 
 
@@ -116,7 +124,7 @@ def simulate(height, width):
         for y in range(height):
             for x in range(width):
                 yield from step_cell(y, x)
-                yield TICK
+        yield TICK
 
 
 class Grid(object):
@@ -132,7 +140,7 @@ class Grid(object):
         for idx in range(self.height):
             s += ''.join(self.rows[idx])
             s += '\n'
-            return s
+        return s
 
     def query(self, y, x):
         return self.rows[y % self.height][x % self.width]
@@ -151,11 +159,369 @@ def live_a_generation(grid, sim):
             state = grid.query(item.y, item.x)
             #             print(f'Sending state {state}')
             item = sim.send(state)
-            # Transition
+        # Transition
         else:
             progeny.assign(item.y, item.x, item.state)
             item = next(sim)
-            return progeny
+    return progeny
+
+
+def evaluate_cell(grid, y, x):
+    """Drive a single `step_cell` coroutine against `grid`, return its Transition."""
+    it = step_cell(y, x)
+    item = next(it)
+    while isinstance(item, Query):
+        item = it.send(grid.query(item.y, item.x))
+    return item
+
+
+def step_incremental(grid, changed=None):
+    """
+    Advance `grid` by one generation in place, re-evaluating only the cells in
+    `changed` and their neighbors; `None` evaluates every cell. Returns the set
+    of cells that changed, to be passed to the next call. All transitions are
+    computed before any is applied, so cells see the previous generation.
+    """
+    height, width = grid.height, grid.width
+    if changed is None:
+        candidates = ((y, x) for y in range(height) for x in range(width))
+    else:
+        candidates = set()
+        for y, x in changed:
+            candidates.add((y, x))
+            for dy, dx in NEIGHBOR_OFFSETS:
+                candidates.add(((y + dy) % height, (x + dx) % width))
+    transitions = []
+    for y, x in candidates:
+        transition = evaluate_cell(grid, y, x)
+        if transition.state != grid.query(y, x):
+            transitions.append(transition)
+    for transition in transitions:
+        grid.assign(transition.y, transition.x, transition.state)
+    return {(t.y, t.x) for t in transitions}
+
+
+class NumpyGrid(object):
+    """
+    Grid backend storing the cells as a uint8 NumPy array, 1 for ALIVE and 0
+    for EMPTY. It offers the same `query`/`assign` interface as `Grid`, so the
+    coroutine path can still drive it, but `step` computes a whole generation
+    with array-wide operations instead of one `Query` per neighbor.
+    """
+    def __init__(self, height, width, cells=None):
+        self.height = height
+        self.width = width
+        if cells is None:
+            cells = np.zeros((height, width), dtype=np.uint8)
+        assert cells.shape == (height, width), cells.shape
+        self.cells = cells
+
+    @classmethod
+    def from_grid(cls, grid):
+        cells = np.array([[state == ALIVE for state in row] for row in grid.rows],
+                         dtype=np.uint8).reshape(grid.height, grid.width)
+        return cls(grid.height, grid.width, cells)
+
+    def to_grid(self):
+        grid = Grid(self.height, self.width)
+        for y, x in zip(*np.nonzero(self.cells)):
+            grid.assign(y, x, ALIVE)
+        return grid
+
+    def __str__(self):
+        chars = np.where(self.cells, ALIVE, EMPTY)
+        return ''.join(''.join(row) + '\n' for row in chars)
+
+    def query(self, y, x):
+        return ALIVE if self.cells[y % self.height, x % self.width] else EMPTY
+
+    def assign(self, y, x, state):
+        self.cells[y % self.height, x % self.width] = state == ALIVE
+
+    def step(self):
+        return NumpyGrid(self.height, self.width, step_cells(self.cells))
+
+
+def vectorized_game_logic(cells, neighbors):
+    """Array version of `game_logic`, cells and neighbors are same-shape arrays."""
+    return ((neighbors == 3) | ((cells == 1) & (neighbors == 2))).astype(np.uint8)
+
+
+def step_strip(padded):
+    """
+    Compute the next generation of the rows `padded[1:-1]`, using the first and
+    last rows of `padded` as halo rows. Columns wrap around.
+    """
+    rows = padded.astype(np.uint8, copy=False)
+    # vertical sums of the three rows centered on each interior row
+    vertical = rows[:-2] + rows[1:-1] + rows[2:]
+    neighbors = (vertical
+                 + np.roll(vertical, 1, axis=1)
+                 + np.roll(vertical, -1, axis=1)
+                 - rows[1:-1])
+    return vectorized_game_logic(rows[1:-1], neighbors)
+
+
+def step_cells(cells):
+    """Next generation of a uint8 cell array on a torus."""
+    padded = np.concatenate([cells[-1:], cells, cells[:1]])
+    return step_strip(padded)
+
+
+NEIGHBOR_OFFSETS = ((1, 0), (1, 1), (0, 1), (-1, 1),
+                    (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+
+class SparseGrid(object):
+    """
+    Grid backend storing only the coordinates of live cells, so memory and the
+    work per generation grow with the population instead of the area. Wrapping
+    follows `Grid.query`/`Grid.assign`.
+    """
+    def __init__(self, height, width, live=None):
+        self.height = height
+        self.width = width
+        self.live = set() if live is None else set(live)
+
+    def __str__(self):
+        s = ''
+        for y in range(self.height):
+            s += ''.join(self.query(y, x) for x in range(self.width))
+            s += '\n'
+        return s
+
+    def __len__(self):
+        return len(self.live)
+
+    def query(self, y, x):
+        return ALIVE if (y % self.height, x % self.width) in self.live else EMPTY
+
+    def assign(self, y, x, state):
+        cell = (y % self.height, x % self.width)
+        if state == ALIVE:
+            self.live.add(cell)
+        else:
+            self.live.discard(cell)
+
+    def step(self):
+        height, width = self.height, self.width
+        neighbors = Counter()
+        for y, x in self.live:
+            for dy, dx in NEIGHBOR_OFFSETS:
+                neighbors[(y + dy) % height, (x + dx) % width] += 1
+        # only cells next to a live cell can be alive in the next generation
+        progeny = SparseGrid(height, width)
+        for cell, count in neighbors.items():
+            state = ALIVE if cell in self.live else EMPTY
+            if game_logic(state, count) == ALIVE:
+                progeny.live.add(cell)
+        return progeny
+
+
+class BitGrid(object):
+    """
+    Compact grid backend storing each row as an integer bitboard, bit `x` of
+    `rows[y]` being cell (y, x). It keeps the `query`/`assign`/`__str__`
+    interface of `Grid`, so `live_a_generation` still works on it, and `step`
+    computes a generation with whole-row bit operations.
+    """
+    __slots__ = ('height', 'width', 'rows', '_mask')
+
+    def __init__(self, height, width, rows=None):
+        self.height = height
+        self.width = width
+        self.rows = [0] * height if rows is None else list(rows)
+        self._mask = (1 << width) - 1
+
+    def __str__(self):
+        s = ''
+        for row in self.rows:
+            s += ''.join(ALIVE if row >> x & 1 else EMPTY for x in range(self.width))
+            s += '\n'
+        return s
+
+    def query(self, y, x):
+        return ALIVE if self.rows[y % self.height] >> (x % self.width) & 1 else EMPTY
+
+    def assign(self, y, x, state):
+        y = int(y) % self.height
+        bit = 1 << (int(x) % self.width)
+        if state == ALIVE:
+            self.rows[y] |= bit
+        else:
+            self.rows[y] &= ~bit
+
+    def _rotate(self, row):
+        """Return the row shifted one column each way, wrapping around."""
+        width, mask = self.width, self._mask
+        left = ((row << 1) | (row >> (width - 1))) & mask
+        right = (row >> 1) | ((row & 1) << (width - 1))
+        return left, right
+
+    def step(self):
+        height = self.height
+        shifted = [self._rotate(row) for row in self.rows]
+        progeny = [0] * height
+        for y in range(height):
+            above, below = (y - 1) % height, (y + 1) % height
+            inputs = (self.rows[above], *shifted[above],
+                      *shifted[y],
+                      self.rows[below], *shifted[below])
+            # bit-sliced counter: ones/twos hold the count bits, fours is set
+            # for every count of 4 or more
+            ones = twos = fours = 0
+            for bits in inputs:
+                carry = ones & bits
+                ones ^= bits
+                fours |= twos & carry
+                twos ^= carry
+            row = self.rows[y]
+            progeny[y] = twos & ~fours & (ones | row)
+        return BitGrid(height, self.width, progeny)
+
+
+def _step_strip_worker(shm_name, height, width, row_start, row_stop, generations, barrier):
+    """
+    Step rows [row_start, row_stop) for `generations` generations. Both
+    generation buffers live in shared memory; the halo rows above and below the
+    strip are read straight from the neighboring strips' rows there.
+    """
+    shm = SharedMemory(name=shm_name)
+    buffers = np.ndarray((2, height, width), dtype=np.uint8, buffer=shm.buf)
+    try:
+        rows = np.arange(row_start - 1, row_stop + 1) % height
+        for gen in range(generations):
+            current, progeny = buffers[gen % 2], buffers[(gen + 1) % 2]
+            progeny[row_start:row_stop] = step_strip(current[rows])
+            barrier.wait()
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        del buffers
+        shm.close()
+
+
+def run_parallel(grid, generations, num_workers=None):
+    """
+    Step `grid` (a `Grid` or `NumpyGrid`) for `generations` generations by
+    splitting it into row strips, one per worker process. Workers synchronize on
+    a barrier after every generation, so the result matches the serial
+    `live_a_generation` exactly. Returns a `NumpyGrid`.
+    """
+    if not isinstance(grid, NumpyGrid):
+        grid = NumpyGrid.from_grid(grid)
+    height, width = grid.height, grid.width
+    num_workers = min(num_workers or cpu_count(), height)
+
+    shm = SharedMemory(create=True, size=2 * height * width)
+    buffers = np.ndarray((2, height, width), dtype=np.uint8, buffer=shm.buf)
+    try:
+        buffers[0] = grid.cells
+        bounds = np.linspace(0, height, num_workers + 1).astype(int)
+        barrier = Barrier(num_workers)
+        procs = [Process(target=_step_strip_worker,
+                         args=(shm.name, height, width, bounds[i], bounds[i+1],
+                               generations, barrier))
+                 for i in range(num_workers)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        failed = [proc.exitcode for proc in procs if proc.exitcode != 0]
+        assert not failed, f'strip workers exited with {failed}'
+        cells = buffers[generations % 2].copy()
+    finally:
+        del buffers
+        shm.close()
+        shm.unlink()
+    return NumpyGrid(height, width, cells)
+
+
+class GridHistory(object):
+    """
+    Append-only on-disk store of generations. The file is a small header
+    followed by one fixed-size record per generation holding the cells packed
+    8 per byte, so generation N is read through a memory map without loading
+    the others and the writer keeps no generations in memory.
+    """
+    MAGIC = b'LIFEHIST'
+    HEADER = struct.Struct('<8sQQ')
+
+    def __init__(self, path, height=None, width=None):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                magic, height_, width_ = self.HEADER.unpack(f.read(self.HEADER.size))
+            assert magic == self.MAGIC, f'{path} is not a grid history file'
+            assert height in (None, height_) and width in (None, width_), \
+                f'{path} holds {height_}x{width_} grids, not {height}x{width}'
+            height, width = height_, width_
+        else:
+            assert height is not None and width is not None, 'new history needs a grid size'
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, height, width))
+        self.height = height
+        self.width = width
+        self.record_size = (height * width + 7) // 8
+
+    def __len__(self):
+        # a partially written trailing record (e.g. after a crash) is ignored
+        return (os.path.getsize(self.path) - self.HEADER.size) // self.record_size
+
+    def append(self, grid):
+        if not isinstance(grid, NumpyGrid):
+            grid = NumpyGrid.from_grid(grid)
+        assert (grid.height, grid.width) == (self.height, self.width)
+        # drop any partial record so the new one lands on a record boundary
+        end = self.HEADER.size + len(self) * self.record_size
+        with open(self.path, 'r+b') as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(np.packbits(grid.cells).tobytes())
+
+    def packed(self, n):
+        """Zero-copy view of the packed bytes of generation `n`."""
+        count = len(self)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError(f'generation {n} not in history of {count}')
+        return np.memmap(self.path, dtype=np.uint8, mode='r',
+                         offset=self.HEADER.size + n * self.record_size,
+                         shape=(self.record_size,))
+
+    def __getitem__(self, n):
+        cells = np.unpackbits(self.packed(n), count=self.height * self.width)
+        return NumpyGrid(self.height, self.width, cells.reshape(self.height, self.width))
+
+
+def simulate_with_history(path, generations, grid=None):
+    """
+    Run the coroutine `simulate` until `path` holds `generations` generations
+    after the start grid, appending each one as it is produced. If `path`
+    already has generations the run resumes from the last one, so an
+    interrupted run picks up where it stopped; a `grid` given then must be
+    the start grid of that run. Returns the last grid.
+    """
+    if grid is None:
+        history = GridHistory(path)
+    else:
+        history = GridHistory(path, grid.height, grid.width)
+        if len(history) == 0:
+            history.append(grid)
+        else:
+            start = grid if isinstance(grid, NumpyGrid) else NumpyGrid.from_grid(grid)
+            assert np.array_equal(history[0].cells, start.cells), \
+                f'{path} holds a run from a different start grid'
+    assert len(history) > 0, f'{path} has no generation to resume from'
+    grid = history[-1].to_grid()
+    # `simulate` holds no state across a TICK, so a fresh one resumes exactly
+    sim = simulate(grid.height, grid.width)
+    while len(history) <= generations:
+        grid = live_a_generation(grid, sim)
+        history.append(grid)
+    return grid
 
 
 def demo_game():
@@ -173,6 +539,139 @@ def demo_game():
         print(f'Generation {i}:\n{grid}')
 
 
+def demo_numpy_game():
+    grid = NumpyGrid(5, 9)
+    grid.assign(0, 3, ALIVE)
+    grid.assign(1, 4, ALIVE)
+    grid.assign(2, 3, ALIVE)
+    grid.assign(2, 4, ALIVE)
+    grid.assign(2, 5, ALIVE)
+    print(f'Start grid\n{grid}')
+
+    for i in range(5):
+        grid = grid.step()
+        print(f'Generation {i}:\n{grid}')
+
+
+def demo_sparse_game(generations=240):
+    """Run a Gosper glider gun on a 10^6 x 10^6 board."""
+    gun = ['------------------------*-----------',
+           '----------------------*-*-----------',
+           '------------**------**------------**',
+           '-----------*---*----**------------**',
+           '**--------*-----*---**--------------',
+           '**--------*---*-**----*-*-----------',
+           '----------*-----*-------*-----------',
+           '-----------*---*--------------------',
+           '------------**----------------------']
+    grid = SparseGrid(10 ** 6, 10 ** 6)
+    for y, row in enumerate(gun):
+        for x, state in enumerate(row):
+            grid.assign(y, x, state)
+    start = time()
+    for _ in range(generations):
+        grid = grid.step()
+    end = time()
+    print(f'Sparse: {generations} generations of a glider gun on 10^6 x 10^6 took '
+          f'{end-start:.3f} seconds, {len(grid)} cells alive')
+
+
+def demo_incremental_game(height=200, width=200, generations=50):
+    """
+    A board that settles into still lifes: after the first generation the
+    incremental mode only re-evaluates the blinker.
+    """
+    grid = Grid(height, width)
+    for y in range(0, height - 4, 10):
+        for x in range(0, width - 4, 10):
+            # 2x2 block
+            for dy, dx in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                grid.assign(y + dy, x + dx, ALIVE)
+    for x in range(5, 8):
+        grid.assign(5, x, ALIVE)
+
+    start = time()
+    changed = None
+    for _ in range(generations):
+        changed = step_incremental(grid, changed)
+    end = time()
+    print(f'Incremental: {generations} generations of {height}x{width} took {end-start:.3f} seconds')
+
+    sim = simulate(height, width)
+    start = time()
+    for _ in range(generations):
+        grid = live_a_generation(grid, sim)
+    end = time()
+    print(f'Full: {generations} generations of {height}x{width} took {end-start:.3f} seconds')
+
+
+def demo_history():
+    grid = Grid(5, 9)
+    grid.assign(0, 3, ALIVE)
+    grid.assign(1, 4, ALIVE)
+    grid.assign(2, 3, ALIVE)
+    grid.assign(2, 4, ALIVE)
+    grid.assign(2, 5, ALIVE)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'life_history.bin')
+        simulate_with_history(path, 3, grid)
+        # resume the same run up to generation 8
+        simulate_with_history(path, 8)
+        history = GridHistory(path)
+        print(f'{len(history)} generations in {path}, generation 8:\n{history[8]}')
+
+
+def benchmark_bit_game(height=1000, width=1000, generations=10):
+    rng = np.random.default_rng(0)
+    cells = rng.random((height, width)) < 0.3
+    grid = BitGrid(height, width)
+    for y in range(height):
+        grid.rows[y] = int.from_bytes(np.packbits(cells[y], bitorder='little').tobytes(),
+                                      'little')
+    start = time()
+    for _ in range(generations):
+        grid = grid.step()
+    end = time()
+    print(f'Bit-packed: {generations} generations of {height}x{width} took '
+          f'{end-start:.3f} seconds, {generations/(end-start):.1f} generations per second')
+
+
+def benchmark_parallel_game(height=4000, width=4000, generations=20):
+    rng = np.random.default_rng(0)
+    grid = NumpyGrid(height, width, (rng.random((height, width)) < 0.3).astype(np.uint8))
+    for num_workers in sorted({1, 2, 4, cpu_count()}):
+        start = time()
+        run_parallel(grid, generations, num_workers)
+        end = time()
+        print(f'{num_workers} workers: {generations} generations of {height}x{width} '
+              f'took {end-start:.3f} seconds')
+
+
+def benchmark_numpy_game(height=1000, width=1000, generations=10):
+    """
+    Compare generations per second of the coroutine path and the NumPy backend.
+    The coroutine path only gets a small grid since it is orders of magnitude
+    slower.
+    """
+    rng = np.random.default_rng(0)
+    cells = (rng.random((height, width)) < 0.3).astype(np.uint8)
+
+    small = NumpyGrid(100, 100, cells[:100, :100].copy()).to_grid()
+    sim = simulate(small.height, small.width)
+    start = time()
+    small = live_a_generation(small, sim)
+    end = time()
+    print(f'Coroutine: 1 generation of 100x100 took {end-start:.3f} seconds')
+
+    grid = NumpyGrid(height, width, cells)
+    start = time()
+    for _ in range(generations):
+        grid = grid.step()
+    end = time()
+    print(f'NumPy: {generations} generations of {height}x{width} took {end-start:.3f} seconds, '
+          f'{generations/(end-start):.1f} generations per second')
+
+
 if __name__ == '__main__':
     demo_count_neighbors()
     demo_step_cell()
@@ -1,6 +1,61 @@
 '''
-Item 41: Consider concurrent.futures for True parallelism 
+Item 41: Consider concurrent.futures for True parallelism
+
+`threads.factorize_threads` shows that threads give no speedup for CPU-bound
+work because of the GIL. `ProcessPoolExecutor` runs the function in child
+processes instead, each with its own interpreter and GIL, so CPU-bound work
+spreads over all the cores. Arguments and results are pickled to and from the
+children, so inputs are sent in chunks to amortize that cost.
 '''
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+
+from py_learn.effective_python.threads import (factorize, factorize_serial,
+                                               factorize_threads, numbers)
+
+BACKENDS = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+
+def parallel_map(func, iterable, max_workers=None, chunksize=None, backend='process'):
+    """
+    Return `[func(item) for item in iterable]`, computed by a pool of workers.
+
+    The 'process' backend is for CPU-bound functions, which must be picklable
+    (defined at module level). The 'thread' backend is for I/O-bound functions.
+    Without `chunksize`, the items are split into about 4 chunks per worker,
+    which keeps the workers balanced without a round trip per item.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'backend must be one of {sorted(BACKENDS)}, got {backend!r}')
+    items = list(iterable)
+    max_workers = max_workers or os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, -(-len(items) // (4 * max_workers)))
+    with BACKENDS[backend](max_workers=max_workers) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+def factorize_list(number):
+    return list(factorize(number))
+
+
+def factorize_pool(backend='process'):
+    start = time()
+    parallel_map(factorize_list, numbers, max_workers=len(numbers), backend=backend)
+    end = time()
+    label = {'process': 'processes', 'thread': 'threads (executor)'}[backend]
+    print(f'{len(numbers)} {label} factorize took {end-start:.3f} seconds')
+
+
+def benchmark():
+    """Compare serial, threads and processes on the same CPU-bound workload."""
+    print(f'Factorize {numbers} on {os.cpu_count()} cores')
+    factorize_serial()
+    factorize_threads()
+    factorize_pool('thread')
+    factorize_pool('process')
+
 
 if __name__ == '__main__':
-    pass
+    benchmark()
@@ -0,0 +1,171 @@
+"""
+Fast factorization behind `threads.factorize`.
+
+`threads.factorize` tests every integer up to n. Here a number is split into
+prime factors, and the divisors are built from the prime factorization. Primes
+below `_SMALL_PRIME_LIMIT`, taken from a cached sieve, are divided out by trial
+division. The cofactor left is tested with Miller-Rabin and, if composite,
+split with Pollard-Brent rho, which keeps numbers with large prime factors
+cheap. The Miller-Rabin test is exact below `_MR_LIMIT`; above it, extra random
+bases make a wrong answer vanishingly unlikely (at most 4**-_MR_RANDOM_ROUNDS).
+"""
+import random
+from bisect import bisect_right
+from math import gcd, isqrt
+from time import time
+
+_sieve_limit = 1
+_primes = []
+
+
+def primes_up_to(limit):
+    """All primes <= `limit`, extending the cached sieve if needed."""
+    global _sieve_limit, _primes
+    if limit > _sieve_limit:
+        # at least double, so a stream of growing inputs sieves O(log n) times
+        new_limit = max(limit, 2 * _sieve_limit)
+        sieve = bytearray([1]) * (new_limit + 1)
+        sieve[:2] = b'\x00\x00'
+        for i in range(2, isqrt(new_limit) + 1):
+            if sieve[i]:
+                sieve[i*i::i] = bytes(len(range(i*i, new_limit + 1, i)))
+        _primes = [i for i in range(2, new_limit + 1) if sieve[i]]
+        _sieve_limit = new_limit
+    return _primes[:bisect_right(_primes, limit)]
+
+
+# Miller-Rabin with these bases is exact for every n < _MR_LIMIT
+_WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+_MR_LIMIT = 3317044064679887385961981
+# random bases added to the fixed ones for numbers of at least _MR_LIMIT
+_MR_RANDOM_ROUNDS = 32
+# trial division bound before the cofactor is tested for primality
+_SMALL_PRIME_LIMIT = 1000
+
+
+def is_prime(number):
+    if number < 2:
+        return False
+    for prime in _WITNESSES:
+        if number % prime == 0:
+            return number == prime
+    d, s = number - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    bases = list(_WITNESSES)
+    if number >= _MR_LIMIT:
+        bases += [random.randrange(2, number - 1) for _ in range(_MR_RANDOM_ROUNDS)]
+    for a in bases:
+        x = pow(a, d, number)
+        if x == 1 or x == number - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % number
+            if x == number - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def pollard_brent(number):
+    """A non-trivial factor of the odd composite `number`."""
+    for c in range(1, number):
+        y, r, q, m = 2, 1, 1, 128
+        factor = 1
+        while factor == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % number
+            k = 0
+            while k < r and factor == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % number
+                    q = q * abs(x - y) % number
+                factor = gcd(q, number)
+                k += m
+            r *= 2
+        if factor == number:
+            # the batched gcd overshot, step back one at a time
+            factor = 1
+            while factor == 1:
+                ys = (ys * ys + c) % number
+                factor = gcd(abs(x - ys), number)
+        if factor != number:
+            return factor
+    raise ValueError(f'no factor found for {number}')
+
+
+def _split(number):
+    """Prime factors, with repetition, of `number` with no factor below the small primes."""
+    if is_prime(number):
+        return [number]
+    factor = pollard_brent(number)
+    return _split(factor) + _split(number // factor)
+
+
+def prime_factors(number):
+    """Prime factorization of `number` as a list of (prime, exponent) pairs."""
+    factors = []
+    for prime in primes_up_to(_SMALL_PRIME_LIMIT):
+        if prime * prime > number:
+            break
+        if number % prime == 0:
+            exponent = 0
+            while number % prime == 0:
+                number //= prime
+                exponent += 1
+            factors.append((prime, exponent))
+    if number > 1:
+        if number > _SMALL_PRIME_LIMIT ** 2:
+            large = sorted(_split(number))
+            factors.extend((prime, large.count(prime)) for prime in sorted(set(large)))
+        else:
+            factors.append((number, 1))
+    return factors
+
+
+def divisors(number):
+    """All divisors of `number` in ascending order."""
+    if number < 1:
+        return []
+    result = [1]
+    for prime, exponent in prime_factors(number):
+        result = [d * prime ** e for d in result for e in range(exponent + 1)]
+    result.sort()
+    return result
+
+
+def factorize(number):
+    """Drop-in replacement for `threads.factorize`, yielding the same divisors."""
+    yield from divisors(number)
+
+
+def factorize_many(numbers):
+    """Divisors of each of `numbers`, sharing the cached sieve."""
+    numbers = list(numbers)
+    if numbers:
+        primes_up_to(min(isqrt(max(numbers)), _SMALL_PRIME_LIMIT))
+    return [divisors(number) for number in numbers]
+
+
+if __name__ == '__main__':
+    from py_learn.effective_python import threads
+
+    start = time()
+    expected = [list(threads.factorize(number)) for number in threads.numbers]
+    end = time()
+    print(f'threads.factorize took {end-start:.3f} seconds')
+
+    start = time()
+    assert factorize_many(threads.numbers) == expected
+    end = time()
+    print(f'factorize_many took {end-start:.3f} seconds')
+
+    numbers = range(10**12, 10**12 + 10000)
+    start = time()
+    factorize_many(numbers)
+    end = time()
+    print(f'factorize_many of {len(numbers)} numbers around 10^12 took {end-start:.3f} seconds')
@@ -0,0 +1,225 @@
+"""
+Bounded ring-buffer queues to replace the busy-polling `MyQueue`.
+
+`Worker.run` spins on `IndexError` and sleeps 10 ms whenever `MyQueue` is
+empty, which burns CPU and adds latency to every hop. `RingQueue` stores items
+in a preallocated array and blocks on condition variables instead, so a
+consumer wakes up as soon as an item arrives and a producer waits while the
+buffer is full. `SharedRingQueue` is the cross-process variant: fixed-size
+slots in a `multiprocessing.shared_memory` block, with semaphores for
+blocking.
+
+Both are meant for a single producer and a single consumer.
+"""
+import struct
+import time
+from multiprocessing import Process, Queue as ProcessQueue, Semaphore
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from threading import Condition, Lock, Thread
+
+from py_learn.effective_python.use_queue import MyQueue, Worker
+
+
+class RingQueue(object):
+    def __init__(self, capacity):
+        assert capacity >= 1, capacity
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._head = 0
+        self._tail = 0
+        lock = Lock()
+        self._not_empty = Condition(lock)
+        self._not_full = Condition(lock)
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def put(self, item):
+        with self._not_full:
+            while self._tail - self._head == self.capacity:
+                self._not_full.wait()
+            self._items[self._tail % self.capacity] = item
+            self._tail += 1
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while self._tail == self._head:
+                self._not_empty.wait()
+            idx = self._head % self.capacity
+            item = self._items[idx]
+            self._items[idx] = None
+            self._head += 1
+            self._not_full.notify()
+            return item
+
+
+class SharedRingQueue(object):
+    """
+    Ring buffer of byte strings of at most `slot_size` bytes in shared memory.
+    The producer and the consumer each keep their own position, so the queue
+    must be handed to the other process (as a `Process` argument) while it is
+    still empty. The creating process calls `unlink` once both sides are done.
+    """
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, capacity, slot_size=64):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._shm = SharedMemory(create=True, size=capacity * (self.LENGTH.size + slot_size))
+        self._items = Semaphore(0)
+        self._slots = Semaphore(capacity)
+        self._head = 0
+        self._tail = 0
+
+    def __getstate__(self):
+        return (self.capacity, self.slot_size, self._shm.name, self._items, self._slots)
+
+    def __setstate__(self, state):
+        self.capacity, self.slot_size, name, self._items, self._slots = state
+        self._shm = SharedMemory(name=name)
+        self._head = 0
+        self._tail = 0
+
+    def put(self, data):
+        if len(data) > self.slot_size:
+            raise ValueError(f'{len(data)} bytes do not fit a {self.slot_size} byte slot')
+        self._slots.acquire()
+        offset = (self._tail % self.capacity) * (self.LENGTH.size + self.slot_size)
+        self.LENGTH.pack_into(self._shm.buf, offset, len(data))
+        start = offset + self.LENGTH.size
+        self._shm.buf[start:start + len(data)] = data
+        self._tail += 1
+        self._items.release()
+
+    def get(self):
+        self._items.acquire()
+        offset = (self._head % self.capacity) * (self.LENGTH.size + self.slot_size)
+        length, = self.LENGTH.unpack_from(self._shm.buf, offset)
+        start = offset + self.LENGTH.size
+        data = bytes(self._shm.buf[start:start + length])
+        self._head += 1
+        self._slots.release()
+        return data
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+def run_ring_queue():
+    """`run_manual_queue` with `RingQueue`: workers block instead of polling."""
+    download_q = RingQueue(100)
+    resize_q = RingQueue(100)
+    upload_q = RingQueue(100)
+    done_q = RingQueue(1000)
+    threads = [Worker(lambda x: x, download_q, resize_q),
+               Worker(lambda x: x*2, resize_q, upload_q),
+               Worker(lambda x: x-1, upload_q, done_q)]
+
+    for thread in threads:
+        # the workers loop forever, do not keep the interpreter alive for them
+        thread.daemon = True
+        thread.start()
+
+    for i in range(1000):
+        download_q.put(i)
+
+    while len(done_q) < 1000:
+        time.sleep(0.01)
+
+    processed = len(done_q)
+    polled = sum(t.polled_count for t in threads)
+    print(f'processed {processed} items after polling {polled} times')
+
+
+TIMESTAMP = struct.Struct('<d')
+
+
+# Encoders and decoders are passed to producer processes, so they live at
+# module level to be picklable under the spawn and forkserver start methods.
+
+def _same(t):
+    return t
+
+
+def _pack_timestamp(t):
+    return TIMESTAMP.pack(t)
+
+
+def _unpack_timestamp(data):
+    return TIMESTAMP.unpack(data)[0]
+
+
+def _poll_get(queue):
+    """Consumer side of `MyQueue` as `Worker.run` does it."""
+    while True:
+        try:
+            return queue.get()
+        except IndexError:
+            time.sleep(0.01)
+
+
+def _produce(queue, num_items, gap, encode):
+    for _ in range(num_items):
+        queue.put(encode(time.perf_counter()))
+        if gap:
+            time.sleep(gap)
+
+
+def _measure(name, queue, num_items, gap, get, start_producer, decode):
+    latencies = []
+    start = time.perf_counter()
+    producer = start_producer(queue, num_items, gap)
+    for _ in range(num_items):
+        sent = decode(get(queue))
+        latencies.append(time.perf_counter() - sent)
+    end = time.perf_counter()
+    producer.join()
+    latencies.sort()
+    mean = sum(latencies) / num_items
+    p99 = latencies[int(0.99 * (num_items - 1))]
+    mode = 'paced' if gap else 'burst'
+    print(f'{name:>22} {mode}: {num_items/(end-start):>9.0f} items per second, '
+          f'latency mean {mean*1e6:>8.1f} us, p99 {p99*1e6:>8.1f} us')
+
+
+def benchmark_queues(num_items=20000, num_paced=500, gap=0.0005, capacity=1024):
+    """
+    Throughput with a producer putting as fast as it can (burst) and latency
+    with a producer pausing `gap` seconds between items (paced), for thread
+    and process queues. Items carry the time they were put.
+    """
+    def in_thread(queue, n, gap):
+        thread = Thread(target=_produce, args=(queue, n, gap, _same))
+        thread.start()
+        return thread
+
+    def in_process(encode):
+        def start(queue, n, gap):
+            proc = Process(target=_produce, args=(queue, n, gap, encode))
+            proc.start()
+            return proc
+        return start
+
+    for n, g in ((num_items, 0), (num_paced, gap)):
+        _measure('MyQueue (polling)', MyQueue(), n, g, _poll_get, in_thread, _same)
+        _measure('queue.Queue', Queue(capacity), n, g, Queue.get, in_thread, _same)
+        _measure('RingQueue', RingQueue(capacity), n, g, RingQueue.get, in_thread, _same)
+        _measure('multiprocessing.Queue', ProcessQueue(capacity), n, g,
+                 lambda q: q.get(), in_process(_same), _same)
+        ring = SharedRingQueue(capacity, TIMESTAMP.size)
+        try:
+            _measure('SharedRingQueue', ring, n, g, SharedRingQueue.get,
+                     in_process(_pack_timestamp), _unpack_timestamp)
+        finally:
+            ring.close()
+            ring.unlink()
+
+
+if __name__ == '__main__':
+    run_ring_queue()
+    benchmark_queues()
@@ -1,9 +1,16 @@
 """
 Item 36: Use subprocess to Manage Child Processes.
 """
+import importlib
+import os
+import pickle
+import selectors
+import struct
 import subprocess
 import time
 import sys
+import traceback
+from collections import deque, namedtuple
 
 def run_sleep(period):
     proc = subprocess.Popen(['sleep', str(period)])
@@ -34,5 +41,276 @@ def test_parallel():
     end = time.time()
     print('Finished 10 sleep 0.1 processes in %.3f seconds' % (end-start))
     
+
+CommandResult = namedtuple('CommandResult',
+                           ('args', 'returncode', 'stdout', 'stderr', 'wall_time', 'timed_out'))
+
+
+# seconds between exit checks of a child that closed its stdout and stderr
+EXIT_POLL_INTERVAL = 0.01
+
+
+class _RunningCommand(object):
+    def __init__(self, args, timeout):
+        self.args = args
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.start = time.monotonic()
+        self.deadline = None if timeout is None else self.start + timeout
+        self.output = {'stdout': [], 'stderr': []}
+        self.open_streams = 2
+        self.timed_out = False
+
+
+def run_commands(commands, max_procs=None, timeout=None, on_output=None, capture=True):
+    """
+    Run each command (an argument list) of `commands`, keeping at most
+    `max_procs` children running at once. The stdout and stderr of all the
+    running children are read as data arrives through a selector, and passed to
+    `on_output(index, stream_name, data)` if given. A child still running
+    `timeout` seconds after its start is killed. A command that cannot be
+    started gets returncode 127 and the error in its stderr. Returns a
+    `CommandResult` per command, in the order of `commands`; output is kept
+    only with `capture`.
+    """
+    max_procs = max_procs or os.cpu_count()
+    pending = deque(enumerate(commands))
+    running = {}
+    results = [None] * len(pending)
+    selector = selectors.DefaultSelector()
+
+    def launch():
+        while pending and len(running) < max_procs:
+            idx, args = pending.popleft()
+            try:
+                cmd = running[idx] = _RunningCommand(args, timeout)
+            except (OSError, ValueError) as e:
+                results[idx] = CommandResult(args, 127, b'', str(e).encode(), 0.0, False)
+                continue
+            selector.register(cmd.proc.stdout, selectors.EVENT_READ, (idx, 'stdout'))
+            selector.register(cmd.proc.stderr, selectors.EVENT_READ, (idx, 'stderr'))
+
+    def close_stream(stream):
+        selector.unregister(stream)
+        stream.close()
+
+    def finish(idx):
+        cmd = running.pop(idx)
+        returncode = cmd.proc.wait()
+        results[idx] = CommandResult(cmd.args, returncode,
+                                     b''.join(cmd.output['stdout']), b''.join(cmd.output['stderr']),
+                                     time.monotonic() - cmd.start, cmd.timed_out)
+
+    try:
+        launch()
+        while running:
+            deadlines = [cmd.deadline for cmd in running.values() if cmd.deadline is not None]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            if any(cmd.open_streams == 0 for cmd in running.values()):
+                # a child that closed its pipes is polled until it exits
+                wait = EXIT_POLL_INTERVAL if wait is None else min(wait, EXIT_POLL_INTERVAL)
+            for key, _ in selector.select(wait):
+                idx, name = key.data
+                cmd = running[idx]
+                data = os.read(key.fd, 65536)
+                if data:
+                    if on_output is not None:
+                        on_output(idx, name, data)
+                    if capture:
+                        cmd.output[name].append(data)
+                    continue
+                close_stream(key.fileobj)
+                cmd.open_streams -= 1
+            now = time.monotonic()
+            for idx, cmd in list(running.items()):
+                if cmd.open_streams == 0 and cmd.proc.poll() is not None:
+                    finish(idx)
+                elif cmd.deadline is not None and now >= cmd.deadline:
+                    cmd.proc.kill()
+                    cmd.timed_out = True
+                    # do not wait for EOF, grandchildren may hold the pipes open
+                    for stream in (cmd.proc.stdout, cmd.proc.stderr):
+                        if not stream.closed:
+                            close_stream(stream)
+                    finish(idx)
+            launch()
+    finally:
+        # on an error, do not leave children behind
+        for cmd in running.values():
+            cmd.proc.kill()
+            cmd.proc.wait()
+            cmd.proc.stdout.close()
+            cmd.proc.stderr.close()
+        selector.close()
+    return results
+
+
+def test_bounded_parallel(num_procs=100, max_procs=10):
+    """
+    Run `num_procs` short commands, at most `max_procs` at a time, streaming
+    their output, with one command that outlives its timeout.
+    """
+    commands = [['sh', '-c', f'echo start {i}; sleep 0.05; echo done {i} >&2']
+                for i in range(num_procs)]
+    commands.append(['sleep', '10'])
+    lines = [0]
+
+    def on_output(idx, name, data):
+        lines[0] += data.count(b'\n')
+
+    start = time.time()
+    results = run_commands(commands, max_procs, timeout=1.0, on_output=on_output)
+    end = time.time()
+    wall_times = [result.wall_time for result in results]
+    print(f'Finished {len(results)} commands, at most {max_procs} at a time, '
+          f'in {end-start:.3f} seconds, {lines[0]} lines streamed')
+    print(f'Per command wall time: min {min(wall_times):.3f}, '
+          f'mean {sum(wall_times)/len(wall_times):.3f}, max {max(wall_times):.3f} seconds')
+    print(f'Exit codes: {sorted(set(result.returncode for result in results))}, '
+          f'{sum(result.timed_out for result in results)} timed out')
+
+
+# Frames between a `WorkerHostPool` and its hosts: a 4-byte big-endian length
+# followed by that many bytes of pickle. A zero length asks a host to exit.
+FRAME_HEADER = struct.Struct('>I')
+
+
+def _write_frame(stream, obj):
+    payload = b'' if obj is None else pickle.dumps(obj)
+    stream.write(FRAME_HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+
+def _read_frame(stream):
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length, = FRAME_HEADER.unpack(header)
+    if length == 0:
+        return None
+    payload = stream.read(length)
+    assert len(payload) == length, f'truncated frame, {len(payload)} of {length} bytes'
+    return pickle.loads(payload)
+
+
+def _worker_host_main():
+    """
+    Loop of a worker host: read ('module:function', args) requests from stdin
+    and write (ok, result) replies to stdout, until a zero-length frame. Tasks
+    run with fd 1 and `sys.stdout` pointed at stderr, so what they print cannot
+    corrupt the frames.
+    """
+    stdin = sys.stdin.buffer
+    stdout = os.fdopen(os.dup(1), 'wb')
+    sys.stdout.flush()
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    while True:
+        request = _read_frame(stdin)
+        if request is None:
+            return 0
+        func_path, args = request
+        try:
+            module_name, func_name = func_path.split(':')
+            func = getattr(importlib.import_module(module_name), func_name)
+            reply = (True, func(*args))
+        except Exception:
+            reply = (False, traceback.format_exc())
+        _write_frame(stdout, reply)
+
+
+class WorkerHostPool(object):
+    """
+    Pool of long-lived Python helper processes that run tasks sent over their
+    stdin, so a short task costs a pipe round trip instead of a fork and exec.
+    A task is a ('module:function', args) pair, e.g. ('time:sleep', (0.1,)).
+    The helpers start with the parent's `sys.path` as their PYTHONPATH, so a
+    task may name any module the parent can import, including this package's
+    own; the function must be at module level and its arguments and result
+    picklable. A task given as an argument list is an arbitrary binary and
+    falls back to `run_commands`.
+    """
+    def __init__(self, size=None):
+        self.size = size or os.cpu_count()
+        command = [sys.executable, '-u', os.path.abspath(__file__), '--worker-host']
+        # running the file puts its own directory first on the helpers' path,
+        # hand them the parent's path as well so package imports resolve
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(os.path.abspath(p) for p in sys.path))
+        self.hosts = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       env=env)
+                      for _ in range(self.size)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for host in self.hosts:
+            _write_frame(host.stdin, None)
+            host.stdin.close()
+        for host in self.hosts:
+            host.wait()
+            host.stdout.close()
+
+    def run(self, tasks):
+        """Run all `tasks`, returning their results in order."""
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        commands = [(idx, task) for idx, task in enumerate(tasks) if isinstance(task, list)]
+        pending = deque((idx, task) for idx, task in enumerate(tasks) if not isinstance(task, list))
+        errors = []
+        selector = selectors.DefaultSelector()
+        idle = list(self.hosts)
+        busy = 0
+        while pending or busy:
+            while pending and idle:
+                idx, task = pending.popleft()
+                host = idle.pop()
+                _write_frame(host.stdin, task)
+                selector.register(host.stdout, selectors.EVENT_READ, (idx, host))
+                busy += 1
+            for key, _ in selector.select():
+                idx, host = key.data
+                selector.unregister(key.fileobj)
+                reply = _read_frame(host.stdout)
+                assert reply is not None, f'worker host {host.pid} exited'
+                ok, results[idx] = reply
+                if not ok:
+                    errors.append(f'task {tasks[idx]} failed:\n{results[idx]}')
+                idle.append(host)
+                busy -= 1
+        selector.close()
+        if errors:
+            raise RuntimeError(errors[0])
+        if commands:
+            command_results = run_commands([args for _, args in commands], self.size)
+            for (idx, _), result in zip(commands, command_results):
+                results[idx] = result
+        return results
+
+
+def benchmark_spawn_cost(num_cmds=500, max_procs=4):
+    """Cost per command of a `sleep 0` child against a `time.sleep(0)` task on a worker host."""
+    start = time.time()
+    run_commands([['sleep', '0'] for _ in range(num_cmds)], max_procs)
+    end = time.time()
+    print(f'Popen: {num_cmds} commands took {end-start:.3f} seconds, '
+          f'{(end-start)/num_cmds*1000:.3f} ms per command')
+
+    start = time.time()
+    with WorkerHostPool(max_procs) as pool:
+        # one no-op round trip per host, so interpreter startup is not charged to the tasks
+        pool.run([('time:sleep', (0,))] * max_procs)
+        started = time.time()
+        pool.run([('time:sleep', (0,)) for _ in range(num_cmds)])
+        end = time.time()
+    print(f'Worker hosts: {num_cmds} tasks took {end-started:.3f} seconds, '
+          f'{(end-started)/num_cmds*1000:.3f} ms per task, '
+          f'plus {started-start:.3f} seconds to start {max_procs} hosts')
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--worker-host']:
+        sys.exit(_worker_host_main())
     sys.exit(test_parallel())
\ No newline at end of file
@@ -10,7 +10,10 @@ forward progress at a time.
 """
 from threading import Thread
 from time import time
+import asyncio
+import os
 import select
+import socket
 
 
 numbers = [2139079, 1214759, 1516637, 1852285]
@@ -71,7 +74,80 @@ def run_slow_system_call():
         thread.join()
     end = time()
     print(f'5 slow system calls with threads took {end-start:.3f} seconds')
-    
+    run_slow_system_call_event_loop(5)
+
+
+async def slow_timer():
+    await asyncio.sleep(0.1)
+
+
+async def slow_pipe_read():
+    """Wait for a pipe to become readable, its writer fires after 0.1 seconds."""
+    loop = asyncio.get_running_loop()
+    read_fd, write_fd = os.pipe()
+    try:
+        readable = loop.create_future()
+        loop.add_reader(read_fd, lambda: readable.done() or readable.set_result(None))
+        loop.call_later(0.1, os.write, write_fd, b'x')
+        try:
+            await readable
+        finally:
+            loop.remove_reader(read_fd)
+        os.read(read_fd, 1)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+async def slow_socket_read():
+    """Wait on a socket read, its peer sends after 0.1 seconds."""
+    loop = asyncio.get_running_loop()
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        reader.setblocking(False)
+        loop.call_later(0.1, writer.send, b'x')
+        await loop.sock_recv(reader, 1)
+
+
+SLOW_WAITS = {'timer': slow_timer, 'pipe': slow_pipe_read, 'socket': slow_socket_read}
+
+
+def run_slow_system_call_event_loop(count=5, kind='timer'):
+    """
+    Run `count` concurrent blocking waits of `kind` ('timer', 'pipe' or
+    'socket') on a single thread with an asyncio event loop. Pipe and socket
+    waits use two file descriptors each, so large counts need a high enough
+    open file limit.
+    """
+    async def run_all():
+        await asyncio.gather(*(SLOW_WAITS[kind]() for _ in range(count)))
+
+    start = time()
+    asyncio.run(run_all())
+    end = time()
+    print(f'{count} slow system calls ({kind}) with event loop took {end-start:.3f} seconds')
+    return end - start
+
+
+def run_slow_system_call_threads(count=5):
+    start = time()
+    threads = [Thread(target=slow_systemcall) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end = time()
+    print(f'{count} slow system calls with threads took {end-start:.3f} seconds')
+    return end - start
+
+
+def benchmark_slow_system_calls(counts=(5, 100, 1000, 5000), kind='timer'):
+    """Thread per call against one event loop thread as concurrency grows."""
+    for count in counts:
+        run_slow_system_call_threads(count)
+        run_slow_system_call_event_loop(count, kind)
+
+
 if __name__ == '__main__':
     print(f'Factorize {numbers}')
     factorize_serial()
@@ -3,10 +3,19 @@ Item 39: Use Queue to Coordinate Work between Threads
 
 Manage a pipeline of functions.
 """
+import json
 import time
+from collections import namedtuple
+from multiprocessing import Pipe, Process, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from queue import Queue
 from _collections import deque
-from threading import Lock, Thread
+from threading import Event, Lock, Thread
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class MyQueue(object):
@@ -85,20 +94,359 @@ class ClosableQueue(Queue):
             finally:
                 self.task_done()
 
+    # Batch operations take the queue's lock once per batch instead of once per
+    # item. They use the same internals (`_put`, `_get`, the conditions and
+    # `unfinished_tasks`) as `Queue.put`, `Queue.get` and `Queue.task_done`.
+
+    def put_many(self, items):
+        """Put all `items`, blocking while a bounded queue is full."""
+        items = list(items)
+        start = 0
+        with self.not_full:
+            while start < len(items):
+                count = len(items) - start
+                if self.maxsize > 0:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                    count = min(count, self.maxsize - self._qsize())
+                for item in items[start:start + count]:
+                    self._put(item)
+                start += count
+                self.unfinished_tasks += count
+                self.not_empty.notify(count)
+
+    def get_many(self, max_items, max_wait=0.0):
+        """
+        Block until an item is available, then return up to `max_items` items,
+        waiting at most `max_wait` seconds for more to arrive. Collection stops
+        at a SENTINEL, which is returned as the last item.
+        """
+        items = []
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+            deadline = time.monotonic() + max_wait
+            while True:
+                while self._qsize() and len(items) < max_items:
+                    items.append(self._get())
+                    if items[-1] is self.SENTINEL:
+                        break
+                if len(items) == max_items or items[-1] is self.SENTINEL:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            self.not_full.notify(len(items))
+        return items
+
+    def task_done_many(self, count):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - count
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+    def iter_batches(self, max_items, max_wait=0.0):
+        """Batch counterpart of `__iter__`, yielding lists of up to `max_items`."""
+        while True:
+            batch = self.get_many(max_items, max_wait)
+            stop = batch[-1] is self.SENTINEL
+            if stop:
+                batch.pop()
+            try:
+                if batch:
+                    yield batch
+            finally:
+                self.task_done_many(len(batch) + stop)
+            if stop:
+                return
+
+
+def per_item(func):
+    """Turn a function of one item into a batch function for `StoppableWorker`."""
+    return lambda batch: [func(item) for item in batch]
+
+
+class LatencyHistogram(object):
+    """Counts of durations in power-of-two microsecond buckets."""
+    __slots__ = ('counts', 'count', 'total')
+    NUM_BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds, count=1):
+        """Record `count` durations of `seconds` each."""
+        idx = min(int(seconds * 1e6).bit_length(), self.NUM_BUCKETS - 1)
+        self.counts[idx] += count
+        self.count += count
+        self.total += seconds * count
+
+    def merge(self, other):
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.count += other.count
+        self.total += other.total
+
+    def to_dict(self):
+        # bucket i holds durations below 2**i microseconds
+        return {'count': self.count,
+                'mean_seconds': self.total / self.count if self.count else 0.0,
+                'buckets_us': {f'<{2**idx}': count
+                               for idx, count in enumerate(self.counts) if count}}
+
+
+class WorkerStats(object):
+    """
+    Timings of one worker, only written by that worker's thread. Wait time is
+    spent blocked on the input queue (idle), service time in `func` (busy) and
+    blocked time putting results downstream.
+    """
+    def __init__(self):
+        self.wait = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.blocked = 0.0
+        self.items = 0
+
+    def record(self, wait, service, blocked, count):
+        self.wait.add(wait)
+        self.service.add(service / count, count)
+        self.blocked += blocked
+        self.items += count
+
+    def to_dict(self, elapsed):
+        return {'items': self.items,
+                'busy_seconds': self.service.total,
+                'idle_seconds': self.wait.total,
+                'blocked_seconds': self.blocked,
+                'utilization': self.service.total / elapsed if elapsed else 0.0}
+
+
+class StageStats(object):
+    """Per-stage metrics: its workers' stats and samples of its input queue depth."""
+    def __init__(self, name, queue, max_samples=1000):
+        self.name = name
+        self.queue = queue
+        self.workers = []
+        self.depth_samples = deque(maxlen=max_samples)
+
+    def new_worker(self):
+        stats = WorkerStats()
+        self.workers.append(stats)
+        return stats
+
+    def sample(self, now):
+        self.depth_samples.append((now, self.queue.qsize()))
+
+    def to_dict(self, start, now):
+        elapsed = now - start
+        wait, service = LatencyHistogram(), LatencyHistogram()
+        for stats in self.workers:
+            wait.merge(stats.wait)
+            service.merge(stats.service)
+        items = sum(stats.items for stats in self.workers)
+        return {'name': self.name,
+                'items': items,
+                'items_per_second': items / elapsed if elapsed else 0.0,
+                'queue_depth': self.queue.qsize(),
+                'queue_depth_samples': [(t - start, depth) for t, depth in self.depth_samples],
+                'wait_time': wait.to_dict(),
+                'service_time': service.to_dict(),
+                'workers': [stats.to_dict(elapsed) for stats in self.workers]}
+
+
+class PipelineStats(object):
+    """
+    Metrics of all the stages of a `Pipeline`, available as a live `snapshot`
+    or as JSON. Queue depths are sampled every `interval` seconds by a
+    background thread between `start` and `stop`.
+    """
+    def __init__(self, stages, interval=0.1):
+        self.stages = stages
+        self.interval = interval
+        self.start_time = time.perf_counter()
+        self._stopped = Event()
+        self._sampler = Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            now = time.perf_counter()
+            for stage in self.stages:
+                stage.sample(now)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def snapshot(self):
+        now = time.perf_counter()
+        return {'elapsed_seconds': now - self.start_time,
+                'stages': [stage.to_dict(self.start_time, now) for stage in self.stages]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
 
 class StoppableWorker(Thread):
-    def __init__(self, func, in_queue, out_queue):
+    """
+    With `batch_size` set, the worker takes up to `batch_size` items at a time,
+    waiting at most `max_wait` seconds to fill a batch, and `func` maps a list
+    of items to a list of results. With `stats` set, the worker records its
+    timings in that `WorkerStats`; without it, nothing is timed.
+    """
+    def __init__(self, func, in_queue, out_queue, batch_size=0, max_wait=0.0, stats=None):
         super().__init__()
         self.func = func
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.stats = stats
         self.polled_count = 0
         self.work_done = 0
 
     def run(self):
+        if self.stats is not None:
+            return self._run_instrumented()
+        if self.batch_size:
+            for batch in self.in_queue.iter_batches(self.batch_size, self.max_wait):
+                self.polled_count += 1
+                self.out_queue.put_many(self.func(batch))
+                self.work_done += len(batch)
+            return
         for item in self.in_queue:
+            self.polled_count += 1
             result = self.func(item)
             self.out_queue.put(result)
+            self.work_done += 1
+
+    def _run_instrumented(self):
+        if self.batch_size:
+            items = self.in_queue.iter_batches(self.batch_size, self.max_wait)
+            put, count = self.out_queue.put_many, len
+        else:
+            items = iter(self.in_queue)
+            put, count = self.out_queue.put, lambda item: 1
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            got = clock()
+            result = self.func(item)
+            done = clock()
+            put(result)
+            self.polled_count += 1
+            self.work_done += count(item)
+            self.stats.record(got - start, done - got, clock() - done, count(item))
+
+
+# Payloads of at least this many bytes go through shared memory instead of
+# being pickled through the pipe to a process stage.
+SHARED_MIN_BYTES = 64 * 1024
+
+SharedPayload = namedtuple('SharedPayload', ('name', 'shape', 'dtype'))
+
+
+def _to_shared(obj):
+    """
+    Copy a large NumPy array or bytes object into a new shared memory block and
+    return its descriptor; anything else is returned as is. The receiver owns
+    the block and unlinks it in `_from_shared`.
+    """
+    if isinstance(obj, list):
+        return [_to_shared(item) for item in obj]
+    if np is not None and isinstance(obj, np.ndarray) and obj.nbytes >= SHARED_MIN_BYTES:
+        shm = SharedMemory(create=True, size=obj.nbytes)
+        np.ndarray(obj.shape, obj.dtype, buffer=shm.buf)[...] = obj
+        payload = SharedPayload(shm.name, obj.shape, obj.dtype.str)
+    elif isinstance(obj, (bytes, bytearray)) and len(obj) >= SHARED_MIN_BYTES:
+        shm = SharedMemory(create=True, size=len(obj))
+        shm.buf[:len(obj)] = obj
+        payload = SharedPayload(shm.name, len(obj), None)
+    else:
+        return obj
+    shm.close()
+    return payload
+
+
+def _from_shared(obj):
+    if isinstance(obj, list):
+        return [_from_shared(item) for item in obj]
+    if not isinstance(obj, SharedPayload):
+        return obj
+    shm = SharedMemory(name=obj.name)
+    try:
+        if obj.dtype is None:
+            return bytes(shm.buf[:obj.shape])
+        view = np.ndarray(obj.shape, np.dtype(obj.dtype), buffer=shm.buf)
+        result = view.copy()
+        del view
+        return result
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _process_stage_main(conn, func):
+    """Loop of a process stage child: apply `func` to each item received."""
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        try:
+            reply = (True, _to_shared(func(_from_shared(item))))
+        except Exception as e:
+            reply = (False, e)
+        conn.send(reply)
+    conn.close()
+
+
+class ProcessWorker(StoppableWorker):
+    """
+    `StoppableWorker` whose function runs in a child process, so CPU-bound
+    stages use real cores. The thread keeps the `ClosableQueue` protocol and
+    hands each item (or batch) to its child over a pipe, blocking without the
+    GIL until the result is back. `func` must be picklable under the spawn
+    start method.
+    """
+    def __init__(self, func, in_queue, out_queue, batch_size=0, max_wait=0.0, stats=None):
+        super().__init__(self._call_child, in_queue, out_queue, batch_size, max_wait, stats)
+        self.child_func = func
+        self._conn, child_conn = Pipe()
+        self.process = Process(target=_process_stage_main, args=(child_conn, func), daemon=True)
+
+    def start(self):
+        # children share the parent's tracker, which sees both ends of each
+        # shared memory block
+        resource_tracker.ensure_running()
+        self.process.start()
+        super().start()
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self._conn.send(None)
+            self.process.join()
+
+    def _call_child(self, item):
+        self._conn.send(_to_shared(item))
+        ok, result = self._conn.recv()
+        if not ok:
+            raise result
+        return _from_shared(result)
 
 
 def run_Queue():
@@ -124,6 +472,166 @@ def run_Queue():
     print(f'{done_q.qsize()} items finished')
 
 
+class Stage(object):
+    """
+    One step of a `Pipeline`: `func` run by `num_workers` threads reading from
+    an input queue of at most `maxsize` items (0 for unbounded). A full input
+    queue blocks the upstream producers until the stage catches up. With
+    `batch_size` set, `func` works on batches, see `StoppableWorker`. With
+    `processes` set, each worker runs `func` in its own process, see
+    `ProcessWorker`. `name` labels the stage in `PipelineStats`.
+    """
+    def __init__(self, func, num_workers=1, maxsize=0, batch_size=0, max_wait=0.0,
+                 processes=False, name=None):
+        assert num_workers >= 1, num_workers
+        self.func = func
+        self.name = name or getattr(func, '__name__', 'stage')
+        self.processes = processes
+        self.num_workers = num_workers
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+
+class Pipeline(object):
+    """
+    Chain of `Stage`s connected by `ClosableQueue`s, generalizing `run_Queue`.
+    Results go to `done_queue`, which is unbounded unless `done_maxsize` is set;
+    a bounded one must be drained while the pipeline runs. With more than one
+    worker in a stage, items may come out of order. With `instrument` set,
+    `stats` is a `PipelineStats` updated while the pipeline runs, otherwise it
+    is None.
+    """
+    def __init__(self, stages, done_maxsize=0, instrument=False, sample_interval=0.1):
+        self.queues = [ClosableQueue(stage.maxsize) for stage in stages]
+        self.done_queue = ClosableQueue(done_maxsize)
+        out_queues = self.queues[1:] + [self.done_queue]
+        stage_stats = [StageStats(stage.name, in_queue) if instrument else None
+                       for stage, in_queue in zip(stages, self.queues)]
+        self.stats = PipelineStats(stage_stats, sample_interval) if instrument else None
+        self.workers = [[(ProcessWorker if stage.processes else StoppableWorker)(
+                             stage.func, in_queue, out_queue, stage.batch_size, stage.max_wait,
+                             stats and stats.new_worker())
+                         for _ in range(stage.num_workers)]
+                        for stage, in_queue, out_queue, stats
+                        in zip(stages, self.queues, out_queues, stage_stats)]
+
+    def start(self):
+        if self.stats is not None:
+            self.stats.start()
+        for stage_workers in self.workers:
+            for worker in stage_workers:
+                worker.start()
+
+    def put(self, item):
+        self.queues[0].put(item)
+
+    def put_many(self, items):
+        self.queues[0].put_many(items)
+
+    def close(self):
+        """Shut down the stages in order, once all items put so far are done."""
+        for in_queue, stage_workers in zip(self.queues, self.workers):
+            # one sentinel per worker, each worker stops at the first it gets
+            for _ in stage_workers:
+                in_queue.close()
+            in_queue.join()
+            for worker in stage_workers:
+                worker.join()
+        if self.stats is not None:
+            self.stats.stop()
+
+
+def run_Pipeline():
+    pipeline = Pipeline([Stage(lambda x: x, maxsize=100),
+                         Stage(lambda x: x*2, num_workers=4, maxsize=100),
+                         Stage(lambda x: x-1, maxsize=100)])
+    pipeline.start()
+    for i in range(1000):
+        pipeline.put(i)
+    pipeline.close()
+    print(f'{pipeline.done_queue.qsize()} items finished')
+
+
+def benchmark_batching(num_items=200000, batch_size=256):
+    """Items per second of a 3-stage pipeline of tiny functions, per item and batched."""
+    funcs = [lambda x: x, lambda x: x*2, lambda x: x-1]
+    for size in (0, batch_size):
+        stages = [Stage(per_item(func) if size else func, maxsize=10000, batch_size=size)
+                  for func in funcs]
+        pipeline = Pipeline(stages)
+        pipeline.start()
+        start = time.time()
+        if size:
+            for i in range(0, num_items, size):
+                pipeline.put_many(range(i, min(i + size, num_items)))
+        else:
+            for i in range(num_items):
+                pipeline.put(i)
+        pipeline.close()
+        end = time.time()
+        assert pipeline.done_queue.qsize() == num_items
+        print(f'batch size {size or 1}: {num_items/(end-start):.0f} items per second')
+
+
+def resize(image):
+    """CPU-bound stand-in for an image resize."""
+    small = image[::2, ::2].astype(np.float64)
+    for _ in range(20):
+        small = (small + np.roll(small, 1, axis=0) + np.roll(small, 1, axis=1)) / 3
+    return small.astype(image.dtype)
+
+
+def cpu_bound(x):
+    return sum(i * i for i in range(x))
+
+
+def run_process_Pipeline(num_items=40, num_workers=4):
+    """CPU-bound middle stage run by threads and by processes."""
+    for processes in (False, True):
+        pipeline = Pipeline([Stage(lambda x: x, maxsize=10),
+                             Stage(cpu_bound, num_workers, maxsize=10, processes=processes),
+                             Stage(lambda x: x, maxsize=10)])
+        pipeline.start()
+        start = time.time()
+        for _ in range(num_items):
+            pipeline.put(200000)
+        pipeline.close()
+        end = time.time()
+        kind = 'processes' if processes else 'threads'
+        print(f'{num_workers} {kind}: {num_items} CPU-bound items took {end-start:.3f} seconds')
+
+    if np is not None:
+        pipeline = Pipeline([Stage(resize, num_workers, maxsize=10, processes=True)])
+        pipeline.start()
+        for _ in range(num_items):
+            pipeline.put(np.ones((1024, 1024), dtype=np.uint8))
+        pipeline.close()
+        print(f'{pipeline.done_queue.qsize()} images resized through shared memory')
+
+
+def slow_resize(x):
+    time.sleep(0.001)
+    return x * 2
+
+
+def run_instrumented_Pipeline():
+    """The slow middle stage shows up as the busy stage with a deep input queue."""
+    pipeline = Pipeline([Stage(lambda x: x, maxsize=100, name='download'),
+                         Stage(slow_resize, num_workers=2, maxsize=100, name='resize'),
+                         Stage(lambda x: x-1, maxsize=100, name='upload')],
+                        instrument=True)
+    pipeline.start()
+    for i in range(500):
+        pipeline.put(i)
+    pipeline.close()
+    for stage in pipeline.stats.snapshot()['stages']:
+        utilization = [round(worker['utilization'], 2) for worker in stage['workers']]
+        max_depth = max((depth for _, depth in stage['queue_depth_samples']), default=0)
+        print(f"{stage['name']}: {stage['items_per_second']:.0f} items per second, "
+              f"max queue depth {max_depth}, worker utilization {utilization}")
+
+
 def queue_demo():
     in_queue = Queue()
 
@@ -144,3 +652,4 @@ def queue_demo():
 if __name__ == '__main__':
     queue_demo()
     run_Queue()
+    run_Pipeline()
@@ -2,9 +2,11 @@
 Created on Mar 21, 2018
 '''
 import multiprocessing
+import queue
 import time
 import random
 import sys
+from itertools import islice
 
 #
 # Functions used by test code
@@ -37,6 +39,110 @@ def pow3(x):
 def noop(x):
     pass
 
+#
+# Adaptive chunk size
+#
+
+def _run_chunk(func, chunk):
+    start = time.perf_counter()
+    results = [func(x) for x in chunk]
+    return results, time.perf_counter() - start
+
+def adaptive_imap(pool, func, iterable, ordered=True, processes=None,
+                  target_chunk_time=0.02, overhead_ratio=0.1):
+    """
+    Like `pool.imap(func, iterable)` (or `imap_unordered` when not `ordered`),
+    but the chunk size is tuned while the map runs. Each chunk reports its
+    compute time; the rest of its round trip is taken as the IPC and
+    serialization overhead. Chunks grow until they take at least
+    `target_chunk_time` and the overhead is at most `overhead_ratio` of the
+    compute time. When the length of `iterable` is known, chunks shrink again
+    near the end so all `processes` workers stay busy with uneven tasks.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    try:
+        remaining = len(iterable)
+    except TypeError:
+        remaining = None
+    items = iter(iterable)
+    done = queue.Queue()
+    in_flight = {}
+    chunksize = 1
+    per_item = overhead = None
+    next_seq = emit_seq = 0
+    buffered = {}
+
+    def submit():
+        nonlocal next_seq
+        chunk = list(islice(items, chunksize))
+        if not chunk:
+            return False
+        seq = next_seq
+        next_seq += 1
+        in_flight[seq] = time.perf_counter()
+        pool.apply_async(_run_chunk, (func, chunk),
+                         callback=lambda result: done.put((seq, result, None)),
+                         error_callback=lambda error: done.put((seq, None, error)))
+        return True
+
+    # keep two chunks per worker in flight, so workers never wait for the parent
+    while len(in_flight) < 2 * processes and submit():
+        pass
+    while in_flight:
+        seq, result, error = done.get()
+        round_trip = time.perf_counter() - in_flight.pop(seq)
+        if error is not None:
+            raise error
+        results, compute = result
+
+        per_item_now = compute / len(results)
+        per_item = per_item_now if per_item is None else 0.8 * per_item + 0.2 * per_item_now
+        # queueing behind other chunks inflates a round trip, never shrinks it
+        overhead_now = max(round_trip - compute, 0.0)
+        overhead = overhead_now if overhead is None else min(1.05 * overhead, overhead_now)
+        target = max(target_chunk_time, overhead / overhead_ratio)
+        new_size = target / max(per_item, 1e-9)
+        if remaining is not None:
+            remaining -= len(results)
+            new_size = min(new_size, remaining / (4 * processes))
+        chunksize = max(1, int(min(max(new_size, chunksize / 2), chunksize * 2)))
+
+        if ordered:
+            buffered[seq] = results
+            while emit_seq in buffered:
+                yield from buffered.pop(emit_seq)
+                emit_seq += 1
+        else:
+            yield from results
+        while len(in_flight) < 2 * processes and submit():
+            pass
+
+def adaptive_map(pool, func, iterable, processes=None, **kwargs):
+    return list(adaptive_imap(pool, func, iterable, True, processes, **kwargs))
+
+def benchmark_adaptive(num_tasks=200000):
+    PROCESSES = 4
+    with multiprocessing.Pool(PROCESSES) as pool:
+        inputs = list(range(num_tasks))
+        expected = [pow3(x) for x in inputs]
+        for name, run in [
+                ('pool.imap, default chunksize', lambda: list(pool.imap(pow3, inputs))),
+                ('pool.map, default chunksize', lambda: pool.map(pow3, inputs)),
+                ('adaptive_map', lambda: adaptive_map(pool, pow3, inputs, PROCESSES))]:
+            start = time.time()
+            assert run() == expected
+            end = time.time()
+            print(f'{name}: {num_tasks} x pow3 took {end-start:.3f} seconds')
+
+        TASKS = [(mul, (i, 7)) for i in range(40)] + [(plus, (i, 8)) for i in range(40)]
+        for name, run in [
+                ('pool.map, chunksize 20', lambda: pool.map(calculatestar, TASKS, 20)),
+                ('adaptive_map', lambda: adaptive_map(pool, calculatestar, TASKS, PROCESSES))]:
+            start = time.time()
+            run()
+            end = time.time()
+            print(f'{name}: {len(TASKS)} uneven tasks took {end-start:.3f} seconds')
+
 #
 # Test code
 #
@@ -76,6 +182,16 @@ def test():
             print('\t', x)
         print()
 
+        print('Ordered results using adaptive_imap():')
+        for x in adaptive_imap(pool, calculatestar, TASKS, True, PROCESSES):
+            print('\t', x)
+        print()
+
+        print('Unordered results using adaptive_imap():')
+        for x in adaptive_imap(pool, calculatestar, TASKS, False, PROCESSES):
+            print('\t', x)
+        print()
+
         #
         # Test error handling
         #
@@ -153,3 +269,4 @@ def test():
 if __name__ == '__main__':
     multiprocessing.freeze_support()
     test()
+    benchmark_adaptive()
@@ -0,0 +1,85 @@
+'''
+Parameter sweeps over `sum_corr.sim_parallel` with an on-disk cache.
+
+Every (p, corr_coef) cell of a sweep is stored as its own npz file named after
+a hash of all the parameters that determine its result, including the seed.
+An interrupted sweep therefore resumes from the cells already on disk, and a
+rerun with more values only computes the new cells.
+'''
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+
+from py_learn.stat.sum_corr import sim_parallel
+
+
+def cache_key(**params):
+    """Stable hash of the parameters of one sweep cell."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    """
+    Delete the least recently used cache files until the cache holds at most
+    `max_bytes`. Files named in `keep` are never deleted.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+
+def sweep(p_values, corr_values, num_sim=100, num_months=100, seed=0,
+          cache_dir='sum_corr_cache', max_cache_bytes=2**30, processes=None,
+          block_size=1000):
+    """
+    Run `sim_parallel` over the Cartesian product of `p_values` and
+    `corr_values`, returning a dict mapping (p, corr_coef) to the array of
+    aggregated correlations. Cells found in `cache_dir` are loaded instead of
+    recomputed; the cache is trimmed to `max_cache_bytes` least recently used
+    first.
+    """
+    assert seed is not None, 'a cached sweep needs a fixed seed'
+    os.makedirs(cache_dir, exist_ok=True)
+    results = {}
+    used = set()
+    for p, corr_coef in itertools.product(p_values, corr_values):
+        params = dict(num_sim=num_sim, num_months=num_months, p=int(p),
+                      corr_coef=float(corr_coef), seed=seed, block_size=block_size)
+        name = cache_key(**params) + '.npz'
+        path = os.path.join(cache_dir, name)
+        used.add(name)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                results[p, corr_coef] = cached['corr']
+            # mark as recently used for eviction
+            os.utime(path)
+            continue
+        corr = sim_parallel(num_sim, num_months, p, corr_coef, seed=seed,
+                            processes=processes, block_size=block_size)
+        # write then rename, so an interrupted write never leaves a bad entry
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, corr=corr, params=json.dumps(params))
+        os.replace(tmp_path, path)
+        results[p, corr_coef] = corr
+        evict(cache_dir, max_cache_bytes, keep=used)
+    return results
+
+
+if __name__ == '__main__':
+    results = sweep([5, 22], [0.1, 0.2, 0.5], num_sim=1000)
+    for (p, corr_coef), corr in results.items():
+        print(f'p={p}, corr_coef={corr_coef}: mean correlation of the sums {corr.mean():.4f}')
@@ -0,0 +1,112 @@
+'''
+One-pass correlation of sums for series that do not fit in memory.
+
+`PeriodCorrStream` consumes (x, y) chunks of any length, from a file or a
+generator, and keeps running moments both of the raw values and of their
+period aggregates, emitting the correlation within each period as soon as the
+period is complete. Moments are merged chunk by chunk with the numerically
+stable pairwise form of Welford's update.
+'''
+import numpy as np
+
+from py_learn.stat.sum_corr import AGGREGATIONS, rowwise_corr, rv_gen_with_corr
+
+
+class RunningCorr(object):
+    """Running means, sums of squared deviations and co-deviation of (x, y)."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.m2_x = 0.0
+        self.m2_y = 0.0
+        self.c_xy = 0.0
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        assert x.shape == y.shape
+        n_b = len(x)
+        if n_b == 0:
+            return
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        n = self.n + n_b
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        weight = self.n * n_b / n
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.m2_x += dx @ dx + delta_x * delta_x * weight
+        self.m2_y += dy @ dy + delta_y * delta_y * weight
+        self.c_xy += dx @ dy + delta_x * delta_y * weight
+        self.n = n
+
+    @property
+    def corr(self):
+        return self.c_xy / np.sqrt(self.m2_x * self.m2_y)
+
+
+class PeriodCorrStream(object):
+    """
+    Streaming counterpart of `calc_mean_corr` and the per-period loop of
+    `sim_stop`. `update` returns the correlations of the periods completed by a
+    chunk; `finish` flushes a ragged final period. `raw.corr` and `agg.corr`
+    are the correlations of the raw series and of the period aggregates so far.
+    """
+
+    def __init__(self, p, how='mean'):
+        self.p = p
+        self._aggregate = AGGREGATIONS[how]
+        self.raw = RunningCorr()
+        self.agg = RunningCorr()
+        self._tail_x = np.empty(0)
+        self._tail_y = np.empty(0)
+
+    def update(self, x, y):
+        self.raw.update(x, y)
+        x = np.concatenate([self._tail_x, x])
+        y = np.concatenate([self._tail_y, y])
+        num_full = len(x) // self.p
+        end = num_full * self.p
+        self._tail_x, self._tail_y = x[end:], y[end:]
+        return self._close_periods(x[:end].reshape(num_full, self.p),
+                                   y[:end].reshape(num_full, self.p))
+
+    def finish(self):
+        x, y = self._tail_x, self._tail_y
+        self._tail_x, self._tail_y = np.empty(0), np.empty(0)
+        if len(x) == 0:
+            return np.empty(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._close_periods(x.reshape(1, -1), y.reshape(1, -1))
+
+    def consume(self, chunks):
+        """Feed an iterable of (x, y) chunks, yielding each period's correlation."""
+        for x, y in chunks:
+            yield from self.update(x, y)
+        yield from self.finish()
+
+    def _close_periods(self, x, y):
+        self.agg.update(self._aggregate(x), self._aggregate(y))
+        return rowwise_corr(x, y)
+
+
+def demo(num_months=10000, p=22, corr_coef=0.2, chunk_size=100000):
+    """Stream `num_months` months of days produced on the fly, in chunks."""
+    def chunks():
+        remaining = num_months * p
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            yield rv_gen_with_corr(size, corr_coef)
+            remaining -= size
+
+    stream = PeriodCorrStream(p)
+    month_corr = np.fromiter(stream.consume(chunks()), dtype=float)
+    print(f'{len(month_corr)} months, mean per-month correlation {month_corr.mean():.4f}')
+    print(f'correlation of the days: {stream.raw.corr:.4f}, '
+          f'correlation of the sums: {stream.agg.corr:.4f}')
+
+
+if __name__ == '__main__':
+    demo()
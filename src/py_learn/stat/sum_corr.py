@@ -3,15 +3,19 @@ Created on Feb 4, 2018
 
 @author: jj
 '''
+from functools import lru_cache
+from multiprocessing import Pool
+
 import numpy as np
 
-def rv_gen_with_corr(size, corr_coef):
+def rv_gen_with_corr(size, corr_coef, rng=None):
     """
     Generate random variables samples with `size` and correlation coefficient
-    equal to `corr_coef`
+    equal to `corr_coef`, drawn from `rng` or the global `np.random` state.
     """
-    rv_1 = np.random.normal(size=size)
-    rv_2 = np.random.normal(size=size)
+    rng = np.random if rng is None else rng
+    rv_1 = rng.standard_normal(size=size)
+    rv_2 = rng.standard_normal(size=size)
     corr_mat = np.array([[1.0, corr_coef],
                          [corr_coef, 1.0]])
     L = np.linalg.cholesky(corr_mat)
@@ -19,42 +23,196 @@ def rv_gen_with_corr(size, corr_coef):
 #     print(f'Correlation between the two variables:\n{np.corrcoef(rv[0], rv[1])}')
     return rv[0], rv[1]
 
-def calc_mean_corr(x, y, p):
+AGGREGATIONS = {
+    'mean': lambda periods: periods.mean(axis=-1),
+    'sum': lambda periods: periods.sum(axis=-1),
+    'first': lambda periods: periods[..., 0],
+    'last': lambda periods: periods[..., -1],
+    'min': lambda periods: periods.min(axis=-1),
+    'max': lambda periods: periods.max(axis=-1),
+}
+
+def aggregate(x, p, how='mean'):
+    """
+    Aggregate the last axis of `x` over consecutive periods of length `p` in
+    linear time and memory, by reshaping the full periods into a (..., n, p)
+    view. A ragged final period shorter than `p` is aggregated on its own.
+    `how` is one of the keys of `AGGREGATIONS`.
+    """
+    x = np.asarray(x)
+    func = AGGREGATIONS[how]
+    num_full, rest = divmod(x.shape[-1], p)
+    full = func(x[..., :num_full*p].reshape(x.shape[:-1] + (num_full, p)))
+    if rest == 0:
+        return full
+    tail = func(x[..., num_full*p:].reshape(x.shape[:-1] + (1, rest)))
+    return np.concatenate([full, tail], axis=-1)
+
+def corr_factor(corr_mat, fallback=None):
+    """
+    Factor `L` of the correlation matrix with `L @ L.T == corr_mat`, cached
+    per matrix. A matrix that is not positive definite raises `ValueError`,
+    unless `fallback='eigen'`, in which case the factor comes from an eigen
+    decomposition with negative eigenvalues clipped to zero and rows rescaled
+    to unit variance.
+    """
+    corr_mat = np.ascontiguousarray(corr_mat, dtype=float)
+    if corr_mat.ndim != 2 or corr_mat.shape[0] != corr_mat.shape[1]:
+        raise ValueError(f'correlation matrix must be square, got shape {corr_mat.shape}')
+    return _corr_factor(corr_mat.tobytes(), corr_mat.shape[0], fallback)
+
+@lru_cache(maxsize=64)
+def _corr_factor(key, k, fallback):
+    corr_mat = np.frombuffer(key).reshape(k, k)
+    if not np.allclose(corr_mat, corr_mat.T):
+        raise ValueError('correlation matrix is not symmetric')
+    if not np.allclose(np.diag(corr_mat), 1.0):
+        raise ValueError('correlation matrix must have ones on the diagonal')
+    try:
+        L = np.linalg.cholesky(corr_mat)
+    except np.linalg.LinAlgError:
+        if fallback != 'eigen':
+            raise ValueError('correlation matrix is not positive definite, '
+                             'pass fallback="eigen" to factor it by eigen decomposition')
+        w, V = np.linalg.eigh(corr_mat)
+        L = V * np.sqrt(np.clip(w, 0.0, None))
+        # rescale so the implied matrix keeps ones on the diagonal
+        L /= np.sqrt((L * L).sum(axis=1, keepdims=True))
+    # the factor is shared by every caller of the cache
+    L.flags.writeable = False
+    return L
+
+def rv_gen_k_corr(size, corr_mat, rng=None, out=None, work=None, fallback=None):
+    """
+    Generate `k` series of `size` samples with correlation matrix `corr_mat`,
+    returned as a (k, size) array. `out` and `work` are optional preallocated
+    (k, size) float arrays for the result and the independent draws.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    L = corr_factor(corr_mat, fallback)
+    shape = (L.shape[0], size)
+    work = rng.standard_normal(shape) if work is None else rng.standard_normal(out=work)
+    if out is None:
+        out = np.empty(shape)
+    return np.matmul(L, work, out=out)
+
+def calc_mean_corr_k(rv, p, how='mean'):
+    """
+    Correlation matrix of the aggregations of the rows of `rv` with period
+    length `p`, the k-variate counterpart of `calc_mean_corr`.
+    """
+    return np.corrcoef(aggregate(rv, p, how))
+
+def calc_mean_corr(x, y, p, how='mean'):
     """
     Calculate the correlation between aggregation of `x` and `y` with period length `p`.
     """
     assert len(x) == len(y)
-    assert len(x) % p == 0
-    new_dim = len(x) // p
-    A = np.zeros((new_dim, len(x)))
-    for i in range(new_dim):
-        A[i, (i*p):(i*p+p)] = 1.0/p
-    return np.corrcoef(A @ x, A @ y)[0,1]
+    return np.corrcoef(aggregate(x, p, how), aggregate(y, p, how))[0,1]
 
 def sim(num_sim=100, num_months=100, p=22, corr_coef=0.2):
     size=num_months * p
-    A = np.zeros((num_months, size))
-    for i in range(num_months):
-        A[i, (i*p):(i*p+p)] = 1.0/p
     new_corr_arr = [0] * num_sim
     for i in range(num_sim):
         x, y = rv_gen_with_corr(size, corr_coef)
-        new_corr_arr[i] = np.corrcoef(A @ x, A @ y)[0,1]
+        new_corr_arr[i] = calc_mean_corr(x, y, p)
     return new_corr_arr
 
-def sim_stop(num_sim=100, num_months=100, p=22, corr_coef=0.2):
+def rowwise_corr(a, b):
+    """
+    Correlation coefficient between matching rows of `a` and `b`, i.e.
+    `np.corrcoef(a[i], b[i])[0,1]` for every i in a single vectorized pass.
+    """
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    return (a * b).sum(axis=-1) / np.sqrt((a * a).sum(axis=-1) * (b * b).sum(axis=-1))
+
+def sim_batched(num_sim=100, num_months=100, p=22, corr_coef=0.2,
+                max_bytes=256 * 2**20, rng=None):
+    """
+    Same as `sim`, but draws simulations as (chunk, 2, size) tensors and
+    computes all the aggregated correlations of a chunk at once. The chunk size
+    keeps the working arrays under about `max_bytes`. Returns an array.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    size = num_months * p
+    L = np.linalg.cholesky(np.array([[1.0, corr_coef],
+                                     [corr_coef, 1.0]]))
+    # the normal draws and their period means per simulation
+    bytes_per_sim = 8 * (2 * size + 4 * num_months)
+    chunk = max(1, min(num_sim, max_bytes // bytes_per_sim))
+    new_corr_arr = np.empty(num_sim)
+    for start in range(0, num_sim, chunk):
+        stop = min(start + chunk, num_sim)
+        # the mean is linear, so mixing the period means with L is the same as
+        # mixing the daily draws and is p times cheaper
+        means = L @ aggregate(rng.standard_normal((stop - start, 2, size)), p)
+        new_corr_arr[start:stop] = rowwise_corr(means[:, 0], means[:, 1])
+    return new_corr_arr
+
+def _sim_block(args):
+    seed_seq, num_sim, num_months, p, corr_coef = args
+    return sim_batched(num_sim, num_months, p, corr_coef,
+                       rng=np.random.default_rng(seed_seq))
+
+def sim_parallel(num_sim=100, num_months=100, p=22, corr_coef=0.2, seed=None,
+                 processes=None, block_size=1000):
+    """
+    Run `sim_batched` across a process pool. Simulations are split into
+    blocks of `block_size`, each drawn from its own generator spawned from
+    `np.random.SeedSequence(seed)`. Blocks depend only on `seed` and
+    `block_size`, so the result is bit-identical for any number of processes.
+    """
+    children = np.random.SeedSequence(seed).spawn((num_sim + block_size - 1) // block_size)
+    blocks = [(child, min(block_size, num_sim - i * block_size), num_months, p, corr_coef)
+              for i, child in enumerate(children)]
+    with Pool(processes) as pool:
+        return np.concatenate(pool.map(_sim_block, blocks, chunksize=1) or [np.empty(0)])
+
+def stop_below(threshold):
+    """Default `sim_stop` predicate: aggregated correlation below `threshold`."""
+    return lambda corr: corr < threshold
+
+def _stop_result(x, y, num_months, p):
+    corr_arr = np.zeros(num_months)
+    for j in range(num_months):
+        corr_arr[j] = np.corrcoef(x[(j*p):(j*p+p)], y[(j*p):(j*p+p)])[0,1]
+    return (x, y), (aggregate(x, p), aggregate(y, p)), corr_arr
+
+def sim_stop(num_sim=100, num_months=100, p=22, corr_coef=0.2, threshold=0.02,
+             predicate=None, rng=None):
+    predicate = stop_below(threshold) if predicate is None else predicate
     size=num_months * p
-    A = np.zeros((num_months, size))
-    for i in range(num_months):
-        A[i, (i*p):(i*p+p)] = 1.0/p
     for i in range(num_sim):
-        x, y = rv_gen_with_corr(size, corr_coef)
-        corr = np.corrcoef(A @ x, A @ y)[0,1]
-        if corr < 0.02:
+        x, y = rv_gen_with_corr(size, corr_coef, rng)
+        corr = calc_mean_corr(x, y, p)
+        if predicate(corr):
             print(f'correlation of the sums: {corr}')
             break
-    corr_arr = np.zeros(num_months)
-    for j in range(num_months):
-        corr_arr[j] = np.corrcoef(x[(j*p):(j*p+p)], y[(j*p):(j*p+p)])[0,1]
-    return (x, y), (A @ x, A @ y), corr_arr
+    return _stop_result(x, y, num_months, p)
 
+def sim_stop_batched(num_sim=100, num_months=100, p=22, corr_coef=0.2, threshold=0.02,
+                     predicate=None, rng=None, block_size=256):
+    """
+    Same search as `sim_stop`, but draws `block_size` simulations at a time
+    and evaluates `predicate` on the whole block of aggregated correlations
+    with vectorized code. Blocks consume the random stream in the same order
+    as `sim_stop`, so for the same `rng` state both return the same draw: the
+    first hit in draw order, or the last draw if nothing hits.
+    """
+    predicate = stop_below(threshold) if predicate is None else predicate
+    rng = np.random if rng is None else rng
+    size = num_months * p
+    L = np.linalg.cholesky(np.array([[1.0, corr_coef],
+                                     [corr_coef, 1.0]]))
+    for start in range(0, num_sim, block_size):
+        rv = rng.standard_normal((min(block_size, num_sim - start), 2, size))
+        means = L @ aggregate(rv, p)
+        hits = np.flatnonzero(predicate(rowwise_corr(means[:, 0], means[:, 1])))
+        if len(hits):
+            # redo the hit exactly as `sim_stop` computes it
+            x, y = L @ rv[hits[0]]
+            print(f'correlation of the sums: {calc_mean_corr(x, y, p)}')
+            return _stop_result(x, y, num_months, p)
+    x, y = L @ rv[-1]
+    return _stop_result(x, y, num_months, p)